@@ -3,33 +3,82 @@
 Flask 3.x app with:
 - vehicles (latest summary)
 - accident_events (append-only full history)
-- verbose logging for local debugging
+- verbose logging for local debugging (LOG_LEVEL=DEBUG)
 """
-from flask import Flask, request, jsonify, send_from_directory
-import sqlite3, os, logging, traceback, datetime
+from flask import Flask, request, jsonify, send_from_directory, Response
+import orjson
+import os, sys, logging, logging.handlers, traceback, datetime, queue, atexit
+from contextlib import contextmanager
 from flask_cors import CORS
+from app_common import (DB_PATH, ORJSONProvider, connect_db, rw_conn, rw_lock, open_readers,
+                        stream_json_rows)
 
 # --- App setup ---
 app = Flask(__name__, static_folder="static")
+app.json = ORJSONProvider(app)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)  # dev only
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
+# WARNING by default; set LOG_LEVEL=DEBUG to log every request and its JSON body
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "accident_system.db")
+# Request threads only enqueue log records; a QueueListener thread writes them to stderr.
+# The MemoryHandler only batches DEBUG/INFO: it flushes on every WARNING or worse, every 1024 records, and at exit.
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stderr)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_buffer = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=_log_stream)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_buffer)
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+# message only; the stream handler adds time and level (basicConfig would set BASIC_FORMAT)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_enqueue])
+_log_listener.start()
+
+@atexit.register
+def _stop_logging():
+    _log_listener.stop()
+    _log_buffer.flush()
 
 # --- DB helpers ---
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+@contextmanager
+def get_writer():
+    """
+    Hold the shared writer for a POST route. Any transaction left open on it is
+    rolled back before it is handed to the next caller. (GET routes stream their
+    rows through stream_json_rows, which checks out its own pooled reader.)
+    """
+    with rw_lock:
+        try:
+            yield rw_conn
+        finally:
+            if rw_conn.in_transaction:
+                rw_conn.rollback()
+
+# --- SQL statements ---
+# Hot-path SQL lives here so every call sends identical text and hits the
+# connection's statement cache instead of being re-parsed.
+# RETURNING only yields a row when the vehicle was actually inserted
+_SQL_INSERT_VEHICLE = ("INSERT INTO vehicles (vehicle_id, model, owner, registration, accident_details) VALUES (?, ?, ?, ?, ?) "
+                       "ON CONFLICT(vehicle_id) DO NOTHING RETURNING id")
+_SQL_UPDATE_VEHICLE = "UPDATE vehicles SET model=?, owner=?, registration=?, accident_details=?, created_at=CURRENT_TIMESTAMP WHERE vehicle_id=?"
+# event_time is set explicitly: tables migrated by init_db() have the column without a default
+_SQL_INSERT_EVENT = "INSERT INTO accident_events (vehicle_id, details, meta_json, event_time) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
+_SQL_LIST_VEHICLES = "SELECT id, vehicle_id, model, owner, registration, accident_details, created_at FROM vehicles ORDER BY created_at DESC"
+_SQL_LIST_EVENTS = "SELECT id, vehicle_id, event_time, details, meta_json FROM accident_events ORDER BY event_time DESC LIMIT 500"
+_SQL_LIST_EVENTS_BY_VID = "SELECT id, vehicle_id, event_time, details, meta_json FROM accident_events WHERE vehicle_id=? ORDER BY event_time DESC"
 
 def init_db():
     """
     Ensure required tables and columns exist. Idempotent migration:
+    - switch the db to WAL journal mode (creates the -wal/-shm files up front)
     - create vehicles and accident_events tables if missing
     - add vehicles.created_at if missing
-    - add accident_events.details and accident_events.meta_json if missing
+    - add accident_events.details, accident_events.meta_json and accident_events.event_time if missing
+    - on tables shared with User_app, keep event_time filled from created_at (trigger + backfill)
+    - create the indexes used by /vehicles and /events, then ANALYZE
     """
-    db = get_db()
+    # One-shot connection without a statement cache: the DDL/PRAGMA probes below run
+    # once, so they should not take cache slots on the long-lived pooled connections.
+    db = connect_db("rwc", cached_statements=0)
     try:
         # 1) Ensure base tables exist (without optional columns)
         db.execute("""
@@ -70,19 +119,47 @@ def init_db():
         if "meta_json" not in event_cols:
             db.execute("ALTER TABLE accident_events ADD COLUMN meta_json TEXT;")
             app.logger.info("Migration: added 'meta_json' column to accident_events")
+        if "event_time" not in event_cols:
+            # tables created by User_app have no event_time; ALTER TABLE cannot add a
+            # CURRENT_TIMESTAMP default to a populated table, so it is filled from created_at below
+            db.execute("ALTER TABLE accident_events ADD COLUMN event_time DATETIME;")
+            app.logger.info("Migration: added 'event_time' column to accident_events")
+        if "created_at" in event_cols:
+            # User_app's inserts don't know about event_time; without this they would be
+            # NULL and sort after every other row in /events
+            db.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_events_event_time AFTER INSERT ON accident_events
+            WHEN NEW.event_time IS NULL
+            BEGIN
+                UPDATE accident_events SET event_time = NEW.created_at WHERE id = NEW.id;
+            END;
+            """)
+            # rows inserted before the trigger existed
+            db.execute("UPDATE accident_events SET event_time = created_at WHERE event_time IS NULL;")
+
+        # 4) Indexes for the ORDER BY / WHERE clauses of /vehicles and /events
+        db.execute("CREATE INDEX IF NOT EXISTS idx_events_vid_event_time ON accident_events(vehicle_id, event_time DESC);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_events_event_time ON accident_events(event_time DESC);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_created ON vehicles(created_at DESC);")
 
         db.commit()
+        # refresh sqlite_stat1 so the planner picks up the new indexes
+        db.execute("ANALYZE;")
         app.logger.info("DB initialization/migration completed at %s", DB_PATH)
     finally:
         db.close()
 
-# initialize DB now (Flask 3.x compatible)
-with app.app_context():
-    init_db()
+# initialize DB once at import, before any request is served; a failed
+# migration raises here, so the app never starts on a half-migrated schema
+init_db()
+open_readers()
 
 # --- Request logging for debug ---
 @app.before_request
 def log_request():
+    # don't parse the body just to throw the log line away
+    if not app.logger.isEnabledFor(logging.DEBUG):
+        return
     try:
         preview = None
         if request.method in ("POST", "PUT", "PATCH"):
@@ -103,13 +180,6 @@ def add_vehicle():
         return jsonify(success=True, message="ok (preflight)"), 200
 
     try:
-        raw = request.get_data()
-        app.logger.debug("RAW REQUEST BYTES: %s", raw)
-        try:
-            app.logger.debug("RAW REQUEST TEXT: %s", raw.decode('utf-8'))
-        except Exception as ex:
-            app.logger.debug("Could not decode raw body: %s", ex)
-
         if not request.is_json:
             app.logger.warning("Request is not JSON. Headers: %s", dict(request.headers))
             return jsonify(success=False, message="Expected application/json"), 400
@@ -128,56 +198,46 @@ def add_vehicle():
         if not vehicle_id:
             return jsonify(success=False, message="vehicle_id is required"), 400
 
-        db = get_db()
         action = None
-        try:
-            # Start a transaction (sqlite autocommit disabled while executing multiple statements)
-            # 1) Ensure vehicles has a row for this vehicle_id (insert only if missing)
-            db.execute(
-                "INSERT OR IGNORE INTO vehicles (vehicle_id, model, owner, registration, accident_details) VALUES (?, ?, ?, ?, ?)",
-                (vehicle_id, model, owner, registration, accident_details)
-            )
-
-            # 2) Detect whether row existed before by selecting it
-            cur = db.execute("SELECT id, model, owner, registration, accident_details, created_at FROM vehicles WHERE vehicle_id = ?", (vehicle_id,))
-            existing = cur.fetchone()
-            if existing is None:
-                # unlikely, but treat as created
-                action = "created"
-            else:
-                # If the posted details differ from existing, update the summary (so vehicles is always latest)
-                # We treat identical data as "updated" for simplicity — adjust per your business logic.
+        with get_writer() as db:
+            try:
+                # Start a transaction (sqlite autocommit disabled while executing multiple statements)
+                # 1) Insert the vehicle summary; a returned row means it did not exist before
+                inserted = db.execute(
+                    _SQL_INSERT_VEHICLE,
+                    (vehicle_id, model, owner, registration, accident_details)
+                ).fetchall()
+                if inserted:
+                    action = "created"
+                else:
+                    # 2) Already known: refresh the summary so vehicles is always latest.
+                    # We treat identical data as "updated" for simplicity — adjust per your business logic.
+                    db.execute(
+                        _SQL_UPDATE_VEHICLE,
+                        (model, owner, registration, accident_details, vehicle_id)
+                    )
+                    action = "updated"
+
+                # 3) Append an event to accident_events (always)
+                meta_json = None
+                if meta is not None:
+                    # store meta as JSON string; keep small to avoid huge blobs
+                    try:
+                        meta_json = orjson.dumps(meta).decode()
+                    except Exception:
+                        meta_json = None
+
                 db.execute(
-                    "UPDATE vehicles SET model=?, owner=?, registration=?, accident_details=?, created_at=CURRENT_TIMESTAMP WHERE vehicle_id=?",
-                    (model, owner, registration, accident_details, vehicle_id)
+                    _SQL_INSERT_EVENT,
+                    (vehicle_id, accident_details, meta_json)
                 )
-                # If the row was just inserted by INSERT OR IGNORE above, action should be 'created'
-                # Determine with a quick check: if created_at equals previous value -> updated, else created
-                action = "updated" if existing else "created"
-
-            # 3) Append an event to accident_events (always)
-            meta_json = None
-            if meta is not None:
-                # store meta as JSON string; keep small to avoid huge blobs
-                import json
-                try:
-                    meta_json = json.dumps(meta)
-                except Exception:
-                    meta_json = None
-
-            db.execute(
-                "INSERT INTO accident_events (vehicle_id, details, meta_json) VALUES (?, ?, ?)",
-                (vehicle_id, accident_details, meta_json)
-            )
-
-            db.commit()
-            app.logger.info("add_vehicle: action=%s vehicle_id=%s", action, vehicle_id)
-        except Exception as e:
-            db.rollback()
-            app.logger.exception("DB error during add_vehicle")
-            raise
-        finally:
-            db.close()
+
+                db.commit()
+                app.logger.info("add_vehicle: action=%s vehicle_id=%s", action, vehicle_id)
+            except Exception as e:
+                db.rollback()
+                app.logger.exception("DB error during add_vehicle")
+                raise
 
         # Choose status code: 201 for created, 200 for updated
         status_code = 201 if action == "created" else 200
@@ -191,26 +251,17 @@ def add_vehicle():
 
 @app.route("/vehicles", methods=["GET"])
 def list_vehicles():
-    try:
-        db = get_db()
-        rows = db.execute("SELECT id, vehicle_id, model, owner, registration, accident_details, created_at FROM vehicles ORDER BY created_at DESC").fetchall()
-        return jsonify([dict(r) for r in rows])
-    finally:
-        db.close()
+    return Response(stream_json_rows(_SQL_LIST_VEHICLES), mimetype="application/json")
 
 @app.route("/events", methods=["GET"])
 def list_events():
     # optional query param ?vehicle_id=...
     vehicle_id = request.args.get("vehicle_id")
-    db = get_db()
-    try:
-        if vehicle_id:
-            rows = db.execute("SELECT id, vehicle_id, event_time, details, meta_json FROM accident_events WHERE vehicle_id=? ORDER BY event_time DESC", (vehicle_id,)).fetchall()
-        else:
-            rows = db.execute("SELECT id, vehicle_id, event_time, details, meta_json FROM accident_events ORDER BY event_time DESC LIMIT 500").fetchall()
-        return jsonify([dict(r) for r in rows])
-    finally:
-        db.close()
+    if vehicle_id:
+        rows = stream_json_rows(_SQL_LIST_EVENTS_BY_VID, (vehicle_id,))
+    else:
+        rows = stream_json_rows(_SQL_LIST_EVENTS)
+    return Response(rows, mimetype="application/json")
 
 @app.route("/health")
 def health():
@@ -1,17 +1,39 @@
 # app.py
 import os
-import json
+import sys
+import logging
+import logging.handlers
 import sqlite3
 import time
+import queue
+import atexit
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Thread, Timer
+import orjson
+from cachetools import TTLCache
 from flask import Flask, request, jsonify, g, Response, session
+from flask.logging import default_handler
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
+from app_common import (ORJSONProvider, connect_db, rw_conn, rw_lock, ro_pool, open_readers,
+                        stream_json_rows, password_hasher)
 
 # ---------- config ----------
-BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(os.path.dirname(__file__), "accident_system.db")
+# hardware events are written in batches of up to EVENT_BATCH_SIZE, at most EVENT_BATCH_INTERVAL seconds apart
+EVENT_BATCH_SIZE = 200
+EVENT_BATCH_INTERVAL = 0.05
+# at exit, wait at most this long for queued hardware events to be committed
+EVENT_FLUSH_TIMEOUT = 10
+# every SSE stream gets a keep-alive this often (one shared heartbeat thread)
+SSE_KEEPALIVE_SECONDS = 10
+# resolved vehicles are cached this long; short so accident_details written elsewhere shows up quickly
+VEHICLE_CACHE_SIZE = 1024
+VEHICLE_CACHE_TTL = 5
+# periodic PRAGMA optimize / WAL checkpoint; opt-in so the dev reloader doesn't start extra timers
+DB_MAINTENANCE = os.environ.get("DB_MAINTENANCE", "0") == "1"
+DB_OPTIMIZE_INTERVAL = 15 * 60
+DB_CHECKPOINT_INTERVAL = 60 * 60
 # change these for production
 APP_SECRET = os.environ.get("FLASK_SECRET_KEY", "dev-secret-change-me")
 HW_API_KEY = os.environ.get("HW_API_KEY", "REPLACE_WITH_STRONG_KEY")
@@ -21,35 +43,115 @@ ALLOWED_ORIGINS = ["http://127.0.0.1:5500", "http://localhost:5500", "http://127
 
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = APP_SECRET
 # cookie settings (dev)
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'   # Good default for dev
 app.config['SESSION_COOKIE_SECURE'] = False     # Set True in production with HTTPS
 
+# Request threads only enqueue log records; a QueueListener thread writes them to stderr.
+# The MemoryHandler only batches DEBUG/INFO: it flushes on every WARNING or worse, every 1024 records, and at exit.
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stderr)
+_log_stream.setFormatter(default_handler.formatter)
+_log_buffer = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=_log_stream)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_buffer)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener.start()
+
+@atexit.register
+def _stop_logging():
+    _log_listener.stop()
+    _log_buffer.flush()
+
 # Allow credentialed CORS (cookies)
 CORS(app, supports_credentials=True, resources={r"/*": {"origins": ALLOWED_ORIGINS}})
 
 # ---------- DB helpers ----------
-def get_db():
+def get_db(write=False):
+    """
+    Per-request connection. Reads check out a pooled read-only connection;
+    write=True takes the shared writer and holds rw_lock until teardown.
+    """
+    if write:
+        db = getattr(g, "_writer", None)
+        if db is None:
+            rw_lock.acquire()
+            db = g._writer = rw_conn
+        return db
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH, check_same_thread=False)
-        db.row_factory = sqlite3.Row
+        db = g._database = ro_pool.get()
     return db
 
 @app.teardown_appcontext
 def close_connection(exc):
-    db = getattr(g, "_database", None)
+    db = g.pop("_database", None)
     if db is not None:
-        db.close()
-
-def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
-    rv = cur.fetchall()
+        ro_pool.put(db)
+    writer = g.pop("_writer", None)
+    if writer is not None:
+        # never hand a half-finished transaction to the next request
+        if writer.in_transaction:
+            writer.rollback()
+        rw_lock.release()
+
+def query_db(query, args=(), one=False, as_dicts=False):
+    """
+    Run a read query. as_dicts=True returns plain dicts built straight from tuple
+    rows (column names looked up once per query), for results that go to JSON as-is.
+    """
+    cur = get_db().cursor()
+    if as_dicts:
+        cur.row_factory = None
+    cur.execute(query, args)
+    if as_dicts:
+        names = [col[0] for col in cur.description]
+        rv = [dict(zip(names, r)) for r in cur.fetchall()]
+    else:
+        rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+# ---------- SQL statements ----------
+# Hot-path SQL lives here so every call sends identical text and hits the
+# connection's statement cache instead of being re-parsed.
+_SQL_INSERT_USER = "INSERT INTO users (fullname, username, email, password_hash) VALUES (?, ?, ?, ?)"
+_SQL_SELECT_USER_BY_USERNAME = "SELECT id, username, fullname, password_hash FROM users WHERE username = ?"
+_SQL_UPDATE_USER_PASSWORD = "UPDATE users SET password_hash = ? WHERE id = ?"
+# explicit column lists (no SELECT *) so unused columns such as raw_payload are never decoded
+_VEHICLE_COLUMNS = "id, vehicle_id, model, owner, registration, accident_details"
+_SQL_SELECT_VEHICLE_BY_VID = "SELECT " + _VEHICLE_COLUMNS + " FROM vehicles WHERE vehicle_id = ?"
+_SQL_SELECT_VEHICLE_BY_ID = "SELECT " + _VEHICLE_COLUMNS + " FROM vehicles WHERE id = ?"
+_SQL_LIST_VEHICLES = "SELECT " + _VEHICLE_COLUMNS + " FROM vehicles"
+_SQL_UPSERT_VEHICLE = """INSERT INTO vehicles (vehicle_id, model, owner, registration, accident_details)
+                  VALUES (?, ?, ?, ?, ?)
+                  ON CONFLICT(vehicle_id) DO UPDATE SET
+                    model=excluded.model, owner=excluded.owner, registration=excluded.registration"""
+_SQL_INSERT_EVENT = """INSERT INTO accident_events (vehicle_id,intensity,lat,lng,timestamp,raw_payload)
+                   VALUES (?, ?, ?, ?, ?, ?)"""
+# a numeric vid only addresses vehicles.id when no vehicle uses that text as its vehicle_id
+_SQL_UPDATE_VEHICLE_DETAILS_BY_ID = """UPDATE vehicles SET
+                   accident_details=?, updated_at=CURRENT_TIMESTAMP
+                   WHERE id=? AND NOT EXISTS (SELECT 1 FROM vehicles WHERE vehicle_id=?)"""
+_SQL_UPSERT_VEHICLE_DETAILS = """INSERT INTO vehicles (vehicle_id, accident_details, created_at)
+                   VALUES (?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT(vehicle_id) DO UPDATE SET
+                     accident_details=excluded.accident_details, updated_at=CURRENT_TIMESTAMP"""
+# Event lookups match on the vehicle_id text and/or the numeric id as a string, so
+# there are only ever one or two candidate keys; keep one statement per shape.
+_EVENT_COLUMNS = "id, vehicle_id, intensity, lat, lng, timestamp, created_at"
+_SQL_VEHICLE_EVENTS_1 = ("SELECT " + _EVENT_COLUMNS + " FROM accident_events "
+                         "WHERE vehicle_id = ? ORDER BY timestamp DESC LIMIT 100")
+_SQL_VEHICLE_EVENTS_2 = ("SELECT " + _EVENT_COLUMNS + " FROM accident_events "
+                         "WHERE vehicle_id IN (?, ?) ORDER BY timestamp DESC LIMIT 100")
+_SQL_RECENT_EVENTS_1 = ("SELECT " + _EVENT_COLUMNS + " FROM accident_events "
+                        "WHERE vehicle_id = ? ORDER BY created_at DESC LIMIT 50")
+_SQL_RECENT_EVENTS_2 = ("SELECT " + _EVENT_COLUMNS + " FROM accident_events "
+                        "WHERE vehicle_id IN (?, ?) ORDER BY created_at DESC LIMIT 50")
+
 # ---------- helper: resolve vehicle identifier (accept numeric id or vehicle_id text) ----------
 def find_vehicle_by_identifier(ident):
     """
@@ -63,8 +165,20 @@ def find_vehicle_by_identifier(ident):
     if not ident_str:
         return None, None
 
+    with _vehicle_cache_lock:
+        hit = _vehicle_cache.get(ident_str)
+    if hit is not None:
+        return hit
+    found = _lookup_vehicle(ident_str)
+    # only hits are cached, so a vehicle created by Dev_app or the hardware path is seen right away
+    if found[0] is not None:
+        with _vehicle_cache_lock:
+            _vehicle_cache[ident_str] = found
+    return found
+
+def _lookup_vehicle(ident_str):
     # First try vehicle_id (text)
-    row = query_db("SELECT * FROM vehicles WHERE vehicle_id = ?", (ident_str,), one=True)
+    row = query_db(_SQL_SELECT_VEHICLE_BY_VID, (ident_str,), one=True)
     if row:
         return row, "vehicle_id"
 
@@ -74,15 +188,31 @@ def find_vehicle_by_identifier(ident):
     except Exception:
         return None, None
 
-    row = query_db("SELECT * FROM vehicles WHERE id = ?", (iid,), one=True)
+    row = query_db(_SQL_SELECT_VEHICLE_BY_ID, (iid,), one=True)
     if row:
         return row, "id"
 
     return None, None
 
+# ident -> (row, used_field) of recent find_vehicle_by_identifier hits
+_vehicle_cache = TTLCache(maxsize=VEHICLE_CACHE_SIZE, ttl=VEHICLE_CACHE_TTL)
+_vehicle_cache_lock = Lock()
+
+def invalidate_vehicles(vids):
+    """Drop cached lookups that resolve to, or were made with, any of the written `vids`."""
+    vids = set(vids)
+    with _vehicle_cache_lock:
+        stale = [key for key, (row, used) in _vehicle_cache.items()
+                 if key in vids or row["vehicle_id"] in vids or str(row["id"]) in vids]
+        for key in stale:
+            # pop, not del: an entry may expire between items() and here
+            _vehicle_cache.pop(key, None)
+
 # ---------- init tables ----------
 def init_db():
-    db = sqlite3.connect(DB_PATH)
+    # One-shot connection without a statement cache: the DDL/PRAGMA probes below run
+    # once, so they should not take cache slots on the long-lived pooled connections.
+    db = connect_db("rwc", cached_statements=0)
     cur = db.cursor()
     # users
     cur.execute("""
@@ -121,35 +251,69 @@ def init_db():
       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )""")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_events_vehicle_time ON accident_events(vehicle_id, timestamp DESC)")
+    # /validateID orders a vehicle's events by created_at
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_vid_created ON accident_events(vehicle_id, created_at DESC)")
+    # hardware events stamp created_at/updated_at on vehicles; older databases predate these columns
+    vehicle_cols = [row["name"] for row in cur.execute("PRAGMA table_info(vehicles)").fetchall()]
+    for col in ("created_at", "updated_at"):
+        if col not in vehicle_cols:
+            cur.execute(f"ALTER TABLE vehicles ADD COLUMN {col} TIMESTAMP")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_created ON vehicles(created_at DESC)")
     db.commit()
+    # refresh sqlite_stat1 so the planner picks up the new indexes
+    cur.execute("ANALYZE")
     db.close()
 
 # create tables on start
 init_db()
+open_readers()
 
 # ---------- simple in-memory SSE pubsub ----------
-_sse_subscribers = {}   # vehicle_id -> list of queues (lists)
+# vehicle_id -> tuple of queues. Subscribe/unsubscribe swap in a new tuple under
+# _sse_lock, so sse_publish can iterate a snapshot without taking the lock.
+_sse_subscribers = {}
 _sse_lock = Lock()
 
 def sse_subscribe(vehicle_id):
-    q = []
+    q = queue.SimpleQueue()
     with _sse_lock:
-        _sse_subscribers.setdefault(vehicle_id, []).append(q)
+        _sse_subscribers[vehicle_id] = _sse_subscribers.get(vehicle_id, ()) + (q,)
     return q
 
 def sse_unsubscribe(vehicle_id, q):
     with _sse_lock:
-        arr = _sse_subscribers.get(vehicle_id)
-        if arr and q in arr:
-            arr.remove(q)
+        arr = tuple(sub for sub in _sse_subscribers.get(vehicle_id, ()) if sub is not q)
+        if arr:
+            _sse_subscribers[vehicle_id] = arr
+        else:
+            _sse_subscribers.pop(vehicle_id, None)
 
 def sse_publish(vehicle_id, payload):
-    with _sse_lock:
-        arr = _sse_subscribers.get(vehicle_id, [])
-        for q in arr:
-            q.append(payload)
+    for q in _sse_subscribers.get(vehicle_id, ()):
+        q.put_nowait(payload)
+
+def _sse_heartbeat():
+    """Push a keep-alive into every subscriber queue, so streams never need their own timeout."""
+    while True:
+        time.sleep(SSE_KEEPALIVE_SECONDS)
+        with _sse_lock:
+            subscribers = tuple(_sse_subscribers.values())
+        for queues in subscribers:
+            for q in queues:
+                q.put_nowait("{}")
+
+Thread(target=_sse_heartbeat, name="sse-heartbeat", daemon=True).start()
 
 # ---------- Auth: signup / login / session / logout ----------
+def _check_password(pw_hash, password):
+    """Verify an Argon2 hash, or a werkzeug (PBKDF2/scrypt) hash stored before the switch."""
+    if pw_hash.startswith("$argon2"):
+        try:
+            return password_hasher.verify(pw_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(pw_hash, password)
+
 @app.route("/signup", methods=["POST"])
 def signup():
     data = request.get_json() or {}
@@ -160,11 +324,10 @@ def signup():
     if not fullname or not username or not email or not password:
         return jsonify(success=False, message="All fields are required"), 400
 
-    pw_hash = generate_password_hash(password)
-    db = get_db()
+    pw_hash = password_hasher.hash(password)
+    db = get_db(write=True)
     try:
-        db.execute("INSERT INTO users (fullname, username, email, password_hash) VALUES (?, ?, ?, ?)",
-                   (fullname, username, email, pw_hash))
+        db.execute(_SQL_INSERT_USER, (fullname, username, email, pw_hash))
         db.commit()
     except sqlite3.IntegrityError:
         return jsonify(success=False, message="Username or email already exists"), 400
@@ -179,10 +342,21 @@ def login():
         return jsonify(success=False, message="Username and password required"), 400
 
     db = get_db()
-    user = db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-    db.close()
-    if not user or not check_password_hash(user["password_hash"], password):
+    user = db.execute(_SQL_SELECT_USER_BY_USERNAME, (username,)).fetchone()
+    if not user or not _check_password(user["password_hash"], password):
         return jsonify(success=False, message="Invalid username or password"), 401
+    # upgrade legacy werkzeug hashes (or outdated Argon2 parameters) now that we know the password
+    if not user["password_hash"].startswith("$argon2") or password_hasher.check_needs_rehash(user["password_hash"]):
+        # Argon2 is slow on purpose: hash before taking rw_lock, and hold the lock only for
+        # the UPDATE (get_db(write=True) would keep it until teardown)
+        new_hash = password_hasher.hash(password)
+        with rw_lock:
+            try:
+                rw_conn.execute(_SQL_UPDATE_USER_PASSWORD, (new_hash, user["id"]))
+                rw_conn.commit()
+            except sqlite3.Error:
+                rw_conn.rollback()
+                raise
 
     session.clear()
     session["user_id"] = user["id"]
@@ -214,13 +388,10 @@ def add_vehicle():
     owner = data.get("owner", "")
     registration = data.get("registration", "")
     # store into vehicle_id column (text) so both numeric and alphanumeric ids work
-    db = get_db()
-    db.execute("""INSERT INTO vehicles (vehicle_id, model, owner, registration, accident_details)
-                  VALUES (?, ?, ?, ?, ?)
-                  ON CONFLICT(vehicle_id) DO UPDATE SET
-                    model=excluded.model, owner=excluded.owner, registration=excluded.registration""",
-               (vid, model, owner, registration, None))
+    db = get_db(write=True)
+    db.execute(_SQL_UPSERT_VEHICLE, (vid, model, owner, registration, None))
     db.commit()
+    invalidate_vehicles((vid,))
     return jsonify(success=True, message="vehicle added/updated", vehicle_id=vid), 201
 
 @app.route("/vehicle/<vid>", methods=["GET"])
@@ -239,22 +410,21 @@ def get_vehicle_events(vid):
     candidates = []
     if row:
         # prefer vehicle_id column value when present
-        vtext = row.get("vehicle_id")
+        vtext = row["vehicle_id"]
         if vtext:
             candidates.append(str(vtext))
         # also allow the numeric id (as string) if present
-        iid = row.get("id")
+        iid = row["id"]
         if iid is not None:
             candidates.append(str(iid))
     else:
         # no matching vehicle row; still attempt to query events by provided vid string
         candidates.append(str(vid))
+    # dedupe (vehicle_id may equal str(id)), so only the 1- and 2-key statements are ever needed
+    candidates = list(dict.fromkeys(candidates))
 
-    # build SQL with IN (...) and parameter placeholders
-    placeholders = ",".join("?" for _ in candidates)
-    sql = f"SELECT * FROM accident_events WHERE vehicle_id IN ({placeholders}) ORDER BY timestamp DESC LIMIT 100"
-    rows = query_db(sql, tuple(candidates))
-    events = [dict(r) for r in rows]
+    sql = _SQL_VEHICLE_EVENTS_1 if len(candidates) == 1 else _SQL_VEHICLE_EVENTS_2
+    events = query_db(sql, tuple(candidates), as_dicts=True)
     return jsonify(events=events)
 
 @app.route("/validateID", methods=["POST"])
@@ -296,58 +466,173 @@ def validate_id():
     if not vehicle_row:
         return jsonify(valid=False, message="vehicle not found"), 200
     
-    vehicle = dict(vehicle_row)
-    
+    # unpack by position (column order of _VEHICLE_COLUMNS) rather than copying into a dict
+    iid, vehicle_id, model, owner, registration, accident_details = vehicle_row
+
     # Rename accident_details to accidentDetails for frontend compatibility
     vehicle_out = {
-        "id": vehicle.get("id"),
-        "vehicle_id": vehicle.get("vehicle_id"),
-        "model": vehicle.get("model"),
-        "owner": vehicle.get("owner"),
-        "registration": vehicle.get("registration"),
-        "accidentDetails": vehicle.get("accident_details") or "No recent accidents reported."
+        "id": iid,
+        "vehicle_id": vehicle_id,
+        "model": model,
+        "owner": owner,
+        "registration": registration,
+        "accidentDetails": accident_details or "No recent accidents reported."
     }
 
     # Build candidate keys for events query (vehicle_id text and numeric id as string)
     candidates = []
-    if vehicle.get("vehicle_id"):
-        candidates.append(str(vehicle.get("vehicle_id")))
-    if vehicle.get("id") is not None:
-        candidates.append(str(vehicle.get("id")))
+    if vehicle_id:
+        candidates.append(str(vehicle_id))
+    if iid is not None:
+        candidates.append(str(iid))
     # dedupe
     candidates = list(dict.fromkeys(candidates))
     
     if candidates:
-        placeholders = ",".join("?" for _ in candidates)
-        sql = f"SELECT id, vehicle_id, intensity, lat, lng, timestamp, created_at FROM accident_events WHERE vehicle_id IN ({placeholders}) ORDER BY created_at DESC LIMIT 50"
+        sql = _SQL_RECENT_EVENTS_1 if len(candidates) == 1 else _SQL_RECENT_EVENTS_2
         events = query_db(sql, tuple(candidates))
         
         # Format events for frontend (rename created_at to timestamp if timestamp is missing)
         events_out = []
-        for evt in events:
-            evt_dict = dict(evt)
-            # Use timestamp field, fallback to created_at
-            if not evt_dict.get("timestamp") and evt_dict.get("created_at"):
-                evt_dict["timestamp"] = evt_dict["created_at"]
+        # column order of _EVENT_COLUMNS
+        for eid, evt_vid, intensity, lat, lng, ts, created_at in events:
             # Ensure all expected fields are present
             events_out.append({
-                "id": evt_dict.get("id"),
-                "vehicle_id": evt_dict.get("vehicle_id"),
-                "intensity": evt_dict.get("intensity"),
-                "lat": evt_dict.get("lat"),
-                "lng": evt_dict.get("lng"),
-                "timestamp": evt_dict.get("timestamp")
+                "id": eid,
+                "vehicle_id": evt_vid,
+                "intensity": intensity,
+                "lat": lat,
+                "lng": lng,
+                # Use timestamp field, fallback to created_at
+                "timestamp": ts or created_at
             })
     else:
         events_out = []
 
     return jsonify(valid=True, vehicle=vehicle_out, events=events_out), 200
 
+# ---------- batched event writer ----------
+# /hardware/event only validates and enqueues; a single background thread drains the
+# queue and commits each batch in one transaction, so one fsync covers many events.
+_event_queue = queue.Queue()
+
+def _store_events(cur, events):
+    """Insert `events` and update their vehicles' summaries in one transaction on `cur`."""
+    # the latest notes per vehicle win; one summary update per vehicle in the batch
+    latest_notes = {}
+    for vid, intensity, lat, lng, ts, raw, notes in events:
+        latest_notes[vid] = notes
+    # take the write lock up front instead of upgrading SHARED -> RESERVED mid-transaction
+    cur.execute("BEGIN IMMEDIATE")
+    # always store event.vehicle_id as text string
+    cur.executemany(_SQL_INSERT_EVENT, [evt[:6] for evt in events])
+    for vid, notes in latest_notes.items():
+        # A numeric vid that isn't anyone's vehicle_id may be a numeric id
+        try:
+            iid = int(vid)
+        except Exception:
+            iid = None
+        if iid is not None:
+            cur.execute(_SQL_UPDATE_VEHICLE_DETAILS_BY_ID, (notes, iid, vid))
+            if cur.rowcount:
+                continue
+        # update by vehicle_id, or create a minimal vehicle record (store vid into vehicle_id column)
+        cur.execute(_SQL_UPSERT_VEHICLE_DETAILS, (vid, notes))
+    cur.connection.commit()
+
+def _write_event_batch(batch):
+    written = []
+    with rw_lock:
+        db = rw_conn
+        cur = db.cursor()
+        try:
+            _store_events(cur, batch)
+            written = batch
+        except Exception:
+            db.rollback()
+            app.logger.exception("Failed to write batch of %d hardware events, retrying one by one", len(batch))
+            # one bad row must not drop the rest of the batch
+            for evt in batch:
+                try:
+                    _store_events(cur, [evt])
+                    written.append(evt)
+                except Exception:
+                    db.rollback()
+                    app.logger.exception("Dropped hardware event for vehicle %s", evt[0])
+        finally:
+            cur.close()
+    # one pass over the cache for the whole batch, after the writer lock is released
+    invalidate_vehicles(evt[0] for evt in written)
+
+def _event_writer():
+    while True:
+        batch = [_event_queue.get()]
+        deadline = time.monotonic() + EVENT_BATCH_INTERVAL
+        while len(batch) < EVENT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_event_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _write_event_batch(batch)
+        except Exception:
+            # this is the only writer thread: log and keep draining rather than die
+            app.logger.exception("Event writer failed on a batch of %d hardware events", len(batch))
+        finally:
+            for _ in batch:
+                _event_queue.task_done()
+
+def _flush_events_at_exit():
+    """Like _event_queue.join(), but gives up after EVENT_FLUSH_TIMEOUT seconds."""
+    deadline = time.monotonic() + EVENT_FLUSH_TIMEOUT
+    with _event_queue.all_tasks_done:
+        while _event_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                app.logger.error("Exiting with %d hardware events not written", _event_queue.unfinished_tasks)
+                return
+            _event_queue.all_tasks_done.wait(remaining)
+
+Thread(target=_event_writer, name="event-writer", daemon=True).start()
+# runs before app_common.close_pool (atexit is LIFO), so queued events are committed on shutdown
+atexit.register(_flush_events_at_exit)
+
+# ---------- periodic DB maintenance ----------
+def _schedule_maintenance(interval, sql):
+    """Run `sql` on the writer every `interval` seconds (chained daemon Timers)."""
+    def run():
+        try:
+            with rw_lock:
+                rw_conn.execute(sql).fetchall()
+        except sqlite3.Error:
+            app.logger.exception("DB maintenance failed: %s", sql)
+        _schedule_maintenance(interval, sql)
+    timer = Timer(interval, run)
+    timer.daemon = True
+    timer.start()
+
+if DB_MAINTENANCE:
+    # keep planner stats current as accident_events grows, and cap the -wal file size
+    _schedule_maintenance(DB_OPTIMIZE_INTERVAL, "PRAGMA optimize;")
+    _schedule_maintenance(DB_CHECKPOINT_INTERVAL, "PRAGMA wal_checkpoint(TRUNCATE);")
+
 # ---------- Hardware endpoint (protected by API key) ----------
+def _bindable(value):
+    """True if sqlite3 can bind `value`: None, str, float, or an int within SQLite's signed 64 bits."""
+    if isinstance(value, int):
+        return -2**63 <= value < 2**63
+    return value is None or isinstance(value, (float, str))
+
+def _hw_authorized():
+    key = request.headers.get("X-API-Key") or request.args.get("api_key")
+    return key == HW_API_KEY
+
 @app.route("/hardware/event", methods=["POST"])
 def hardware_event():
-    key = request.headers.get("X-API-Key") or request.args.get("api_key")
-    if key != HW_API_KEY:
+    if not _hw_authorized():
         return jsonify(success=False, message="unauthorized"), 401
     data = request.get_json() or {}
     vid_raw = data.get("vehicleID") if data.get("vehicleID") is not None else data.get("vehicle_id")
@@ -359,57 +644,35 @@ def hardware_event():
     lng = data.get("lng")
     ts = data.get("timestamp") or datetime.utcnow().isoformat()
     notes = data.get("notes") or data.get("accidentDetails") or ""
-    raw = json.dumps(data)
-    db = get_db()
-    cur = db.cursor()
-    # transactional insert and update
-    cur.execute("BEGIN")
-    # always store event.vehicle_id as text string
-    cur.execute("""INSERT INTO accident_events (vehicle_id,intensity,lat,lng,timestamp,raw_payload)
-                   VALUES (?, ?, ?, ?, ?, ?)""", (vid, intensity, lat, lng, ts, raw))
-
-    # Try update by vehicle_id (preferred)
-    cur.execute("""UPDATE vehicles SET
-                   accident_details=?, updated_at=CURRENT_TIMESTAMP
-                   WHERE vehicle_id=?""", (notes, vid))
-    if cur.rowcount == 0:
-        # If not updated and vid is numeric, try updating by numeric id
-        try:
-            iid = int(vid)
-        except Exception:
-            iid = None
-        if iid is not None:
-            cur.execute("""UPDATE vehicles SET
-                           accident_details=?, updated_at=CURRENT_TIMESTAMP
-                           WHERE id=?""", (notes, iid))
-    # if update affected 0 rows, create minimal vehicle record (store vid into vehicle_id column)
-    if cur.rowcount == 0:
-        cur.execute("""INSERT INTO vehicles (vehicle_id, accident_details, created_at)
-                       VALUES (?, ?, CURRENT_TIMESTAMP)""", (vid, notes))
-    db.commit()
+    # checked here: a value SQLite can't bind would otherwise fail in the writer, after the 202
+    for name, value in (("intensity", intensity), ("lat", lat), ("lng", lng), ("timestamp", ts), ("notes", notes)):
+        if not _bindable(value):
+            return jsonify(success=False, message=f"invalid {name}"), 400
+    raw = orjson.dumps(data).decode()
+    # persisted by the event writer thread within EVENT_BATCH_INTERVAL
+    _event_queue.put((vid, intensity, lat, lng, ts, raw, notes))
     # publish to SSE (use vid string)
     payload = {"type":"accident_event", "vehicleID": vid, "intensity": intensity, "lat": lat, "lng": lng, "timestamp": ts, "notes": notes}
-    sse_publish(vid, json.dumps(payload))
-    return jsonify(success=True), 201
+    sse_publish(vid, orjson.dumps(payload).decode())
+    return jsonify(success=True), 202
+
+@app.route("/hardware/flush", methods=["POST"])
+def hardware_flush():
+    """Block until every queued hardware event is committed (used by tests)."""
+    if not _hw_authorized():
+        return jsonify(success=False, message="unauthorized"), 401
+    _event_queue.join()
+    return jsonify(success=True)
 
 # ---------- SSE for vehicle ----------
 @app.route("/stream/vehicle/<vid>")
 def stream_vehicle(vid):
     def event_stream(q):
         try:
-            yield f"data: {json.dumps({'type':'connected','vehicleID':vid})}\n\n"
-            idle_counter = 0
+            yield f"data: {orjson.dumps({'type': 'connected', 'vehicleID': vid}).decode()}\n\n"
             while True:
-                if q:
-                    item = q.pop(0)
-                    yield f"data: {item}\n\n"
-                else:
-                    time.sleep(1)
-                    idle_counter += 1
-                    if idle_counter >= 10:
-                        idle_counter = 0
-                        yield "data: {}\n\n"
-                    continue
+                # woken by sse_publish, or by _sse_heartbeat with a keep-alive
+                yield f"data: {q.get()}\n\n"
         finally:
             sse_unsubscribe(vid, q)
     q = sse_subscribe(vid)
@@ -422,11 +685,7 @@ def index():
 
 @app.route("/vehicles", methods=["GET"])
 def list_vehicles():
-    db = sqlite3.connect(DB_PATH)
-    db.row_factory = sqlite3.Row
-    vehicles = db.execute("SELECT * FROM vehicles").fetchall()
-    db.close()
-    return jsonify([dict(row) for row in vehicles])
+    return Response(stream_json_rows(_SQL_LIST_VEHICLES), mimetype="application/json")
 
 if __name__ == "__main__":
     print("Starting Flask app (sessions enabled)...")
@@ -0,0 +1,115 @@
+# app_common.py
+"""
+Shared by Dev_app and User_app, which serve the same SQLite file:
+- ORJSONProvider (jsonify / request.get_json via orjson)
+- connection setup and the long-lived connections (one writer + read-only pool)
+- stream_json_rows for chunked JSON list responses
+- password_hasher, also used by db_init.py to seed the demo user
+"""
+import os
+import queue
+import sqlite3
+import atexit
+from pathlib import Path
+from threading import Lock
+import orjson
+from argon2 import PasswordHasher
+from flask.json.provider import JSONProvider
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "accident_system.db")
+DB_URI = Path(os.path.abspath(DB_PATH)).as_uri()
+# keep at least one reader per server thread: a streamed response holds its reader until
+# the client has read the last chunk, and checkout blocks while the pool is empty
+DB_READERS = int(os.environ.get("DB_READERS", "16"))
+# per-connection prepared statement cache (stdlib default is 128)
+DB_CACHED_STATEMENTS = 256
+# rows per chunk when streaming JSON list responses
+STREAM_CHUNK_ROWS = 100
+
+# Argon2id hasher shared by User_app and db_init, so seeded and signed-up users hash the same way
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson; used by jsonify() and request.get_json()."""
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # skip the bytes -> str -> bytes round trip dumps() would need
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype="application/json")
+
+# journal_mode=WAL is persisted in the db file, so it only needs to be set once per process;
+# the remaining PRAGMAs are per-connection and are applied on every connect.
+_wal_enabled = False
+
+def tune_connection(conn):
+    global _wal_enabled
+    if not _wal_enabled:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        _wal_enabled = True
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=30000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-20000;")
+
+def connect_db(mode, cached_statements=DB_CACHED_STATEMENTS):
+    conn = sqlite3.connect(f"{DB_URI}?mode={mode}", uri=True, check_same_thread=False,
+                           cached_statements=cached_statements)
+    conn.row_factory = sqlite3.Row
+    tune_connection(conn)
+    return conn
+
+# Long-lived connections: one shared writer (serialized by rw_lock) plus a small pool of
+# read-only connections, so requests no longer reopen the db/-wal/-shm files every time.
+# The writer is opened at import so WAL is on before the apps' init_db() runs.
+rw_conn = connect_db("rwc")
+rw_lock = Lock()
+ro_pool = queue.Queue()
+
+def open_readers():
+    # mode=ro cannot create the file, so the apps call this after init_db()
+    for _ in range(DB_READERS):
+        ro_pool.put(connect_db("ro"))
+
+@atexit.register
+def close_pool():
+    while True:
+        try:
+            ro_pool.get_nowait().close()
+        except queue.Empty:
+            break
+    rw_conn.close()
+
+def stream_json_rows(sql, args=()):
+    """
+    Yield the rows of `sql` as one JSON array, STREAM_CHUNK_ROWS rows at a time,
+    so the first bytes go out while SQLite is still stepping. The generator takes
+    its own pooled reader because it runs after the view (and its teardown) returned.
+    """
+    db = ro_pool.get()
+    try:
+        # plain tuples on this cursor: no sqlite3.Row per row, keys are zipped in once here
+        cur = db.cursor()
+        cur.row_factory = None
+        try:
+            cur.execute(sql, args)
+            names = [col[0] for col in cur.description]
+            sep = b"["
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                yield sep + b",".join(orjson.dumps(dict(zip(names, r))) for r in rows)
+                sep = b","
+            yield b"]" if sep == b"," else b"[]"
+        finally:
+            cur.close()
+    finally:
+        ro_pool.put(db)
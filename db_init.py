@@ -1,14 +1,12 @@
 # db_init.py
 import sqlite3
-import os
-from werkzeug.security import generate_password_hash
-
-DB_PATH = os.path.join(os.path.dirname(__file__), "accident_system.db")
+from app_common import DB_PATH, password_hasher
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL;")
 
     # Create users table if not exists
     cur.execute("""
@@ -59,7 +57,7 @@ def init_db():
 
     if not cur.execute("SELECT 1 FROM users LIMIT 1").fetchone():
         # Insert demo user (password: Demo@1234)
-        demo_pw_hash = generate_password_hash("Demo@1234")
+        demo_pw_hash = password_hasher.hash("Demo@1234")
         cur.execute("""
             INSERT INTO users (fullname, username, email, password_hash)
             VALUES (?, ?, ?, ?)
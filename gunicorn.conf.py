@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+"""
+Production server settings for User_app:
+
+    gunicorn -c gunicorn.conf.py
+
+One worker process on purpose: SSE subscribers (_sse_subscribers), the hardware
+event queue and the SQLite writer lock all live in process memory. Concurrency
+comes from threads instead; SQLite in WAL mode lets the pooled readers run
+alongside the single writer. Multi-process deployments would first need the
+SSE fan-out moved to an external pub/sub (e.g. Redis).
+"""
+import os
+
+wsgi_app = "User_app:app"
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+worker_class = "gthread"
+workers = 1
+# every open /stream/vehicle/<vid> connection holds one of these threads
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+# SSE keep-alives are sent every 10s, well inside this
+timeout = 60
+# the periodic PRAGMA optimize / WAL checkpoint timers are off by default (dev reloader), on here.
+# DB_READERS follows threads so slow /vehicles clients can't drain the reader pool.
+raw_env = [
+    "DB_MAINTENANCE=" + os.environ.get("DB_MAINTENANCE", "1"),
+    "DB_READERS=" + os.environ.get("DB_READERS", str(threads)),
+]